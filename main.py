@@ -2,25 +2,37 @@
 import os
 import re
 import aiohttp
+from aiohttp import web
+import aiofiles
 import asyncio
-import threading
 from pathlib import Path
-from datetime import datetime, timedelta
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
 from pyrogram.types import Message, BotCommand, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from pyrogram.enums import ParseMode
+from pyrogram.errors import FloodWait, InternalServerError, UserIsBlocked, PeerIdInvalid, InputUserDeactivated, UserDeactivated, ChatWriteForbidden
 from PIL import Image
-from hachoir.parser import createParser
-from hachoir.metadata import extractMetadata
 import subprocess
+import signal
 import traceback
 import json 
-from flask import Flask, render_template_string
-import requests
 import time
 import math
+import random
+import hashlib
+import shutil
+import contextlib
+import functools
+import itertools
+from collections import Counter, OrderedDict, deque
 import logging
 
+# uvloop is optional; it must be installed before the Client below creates its event loop
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -37,9 +49,10 @@ TMP.mkdir(parents=True, exist_ok=True)
 
 # state
 USER_THUMBS = {}
-TASKS = {}
+TASKS = {} # {uid: set of cancel events for the user's running operations}
 SET_THUMB_REQUEST = set()
 SUBSCRIBERS = set()
+BROADCAST_TASKS = {} # {uid: set of cancel events for the admin's running broadcasts}
 SET_CAPTION_REQUEST = set()
 USER_CAPTIONS = {}
 # New state for dynamic captions
@@ -47,6 +60,9 @@ USER_COUNTERS = {}
 # New state for edit caption mode
 EDIT_CAPTION_MODE = set()
 USER_THUMB_TIME = {}
+# Generated video thumbnails, keyed by (content hash prefix, size, timestamp) -> cached jpg path
+THUMB_CACHE = OrderedDict()
+THUMB_CACHE_MAX_ENTRIES = 512
 
 # --- STATE FOR AUDIO CHANGE ---
 MKV_AUDIO_CHANGE_MODE = set()
@@ -69,26 +85,76 @@ DEFAULT_POST_DATA = {
 
 ADMIN_ID = int(os.getenv("ADMIN_ID", ""))
 MAX_SIZE = 4 * 1024 * 1024 * 1024
+# Max forwards in flight during /broadcast; keeps the bot under Telegram's ~30 msg/s limit
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))
+# Large URL downloads are fetched as this many parallel byte ranges when the server supports it
+RANGE_DOWNLOAD_PARTS = 8
+RANGE_DOWNLOAD_MIN_SIZE = 32 * 1024 * 1024
+# Minimum seconds between edits of the broadcast progress message
+BROADCAST_PROGRESS_INTERVAL = 3
+# Global pacing for outgoing sends, shared by uploads and broadcasts (Telegram allows ~30 msg/s per bot)
+TG_SEND_RATE = 28
+TG_NEXT_SEND_AT = 0.0
+# URL downloads run at once; later links wait their turn instead of all hitting disk and network together
+DOWNLOAD_SEM = asyncio.Semaphore(int(os.getenv("DOWNLOAD_CONCURRENCY", "3")))
+DOWNLOADS_WAITING = 0
+# Uploads processed at once; each one holds the source file, a converted copy and a thumbnail open
+UPLOAD_SEM = asyncio.BoundedSemaphore(int(os.getenv("UPLOAD_CONCURRENCY", "32")))
+# Lines of ffmpeg stderr kept for error messages
+FFMPEG_STDERR_TAIL = 16
 
 app = Client("mybot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
-flask_app = Flask(__name__)
+
+# Extensions treated as video; anything else is uploaded as a plain document
+VIDEO_EXTS = frozenset({".mp4", ".mkv", ".avi", ".mov", ".flv", ".wmv", ".webm"})
+# Containers uploaded as-is; other video formats are converted to MKV first
+NO_CONVERT_EXTS = frozenset({".mp4", ".mkv"})
+# Streams carried into MKV conversions: video plus any audio and subtitles, never data tracks
+MKV_STREAM_MAP = ("-map", "0:v", "-map", "0:a?", "-map", "0:s?")
+
+# ---- precompiled patterns ----
+DRIVE_ID_PATTERNS = [
+    re.compile(r"/d/([a-zA-Z0-9_-]+)"),
+    re.compile(r"id=([a-zA-Z0-9_-]+)"),
+    re.compile(r"open\?id=([a-zA-Z0-9_-]+)"),
+    re.compile(r"https://drive.google.com/file/d/([a-zA-Z0-9_-]+)/")
+]
+# Characters not allowed in file names, mapped to "_"
+UNSAFE_FILENAME_TABLE = str.maketrans({ch: "_" for ch in '\\/*?"<>|:'})
+# Deletes the parentheses around a counter like "(01)"
+STRIP_PARENS_TABLE = str.maketrans("", "", "()")
+CAPTION_QUALITY_RE = re.compile(r"\[re\s*\((.*?)\)\]")
+CAPTION_COUNTER_RE = re.compile(r"\[\s*(\(?\d+\)?)\s*\]")
+# Quality cycle (group 1) or counter (group 2) placeholder, matched in one pass
+CAPTION_PLACEHOLDER_RE = re.compile(f"{CAPTION_QUALITY_RE.pattern}|{CAPTION_COUNTER_RE.pattern}")
+CAPTION_CONDITIONAL_RE = re.compile(r"\[([a-zA-Z0-9\s]+)\s*\((.*?)\)\]")
+NON_DIGIT_RE = re.compile(r"[^0-9]")
+DRIVE_CONFIRM_RE = re.compile(r"confirm=([0-9A-Za-z-_]+)")
+SEASON_LIST_SPLIT_RE = re.compile(r"[,\s]+")
 
 # ---- utilities ----
 def is_admin(uid: int) -> bool:
     return uid == ADMIN_ID
 
+def admin_only(handler):
+    """Message-handler decorator that refuses non-admins. Goes below @app.on_message so Pyrogram registers the wrapper."""
+    @functools.wraps(handler)
+    async def wrapper(c, m):
+        if m.from_user is None or m.from_user.id != ADMIN_ID:
+            await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
+            return
+        return await handler(c, m)
+    return wrapper
+
+# For handlers that ignore non-admins silently: Pyrogram drops the update before the handler is entered
+admin_filter = filters.create(lambda _, __, m: m.from_user is not None and m.from_user.id == ADMIN_ID)
+
 def is_drive_url(url: str) -> bool:
     return "drive.google.com" in url or "docs.google.com" in url
 
 def extract_drive_id(url: str) -> str:
-    patterns = [
-        r"/d/([a-zA-Z0-9_-]+)",
-        r"id=([a-zA-Z0-9_-]+)",
-        r"open\?id=([a-zA-Z0-9_-]+)",
-        r"https://drive.google.com/file/d/([a-zA-Z0-9_-]+)/"
-    ]
-    for p in patterns:
-        m = re.search(p, url)
+    for p in DRIVE_ID_PATTERNS:
+        m = p.search(url)
         if m:
             return m.group(1)
     return None
@@ -109,18 +175,44 @@ def generate_new_filename(original_name: str) -> str:
         
     return BASE_NEW_NAME + file_ext
 
-def get_video_duration(file_path: Path) -> int:
+async def get_video_duration(file_path: Path) -> int:
+    """Reads the container duration with ffprobe, which only parses the header instead of walking the whole file."""
     try:
-        parser = createParser(str(file_path))
-        if not parser:
+        proc = await asyncio.create_subprocess_exec(
+            "ffprobe",
+            "-v", "error",
+            "-show_entries", "format=duration",
+            "-of", "default=noprint_wrappers=1:nokey=1",
+            str(file_path),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        try:
+            out, _ = await asyncio.wait_for(proc.communicate(), timeout=60)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
             return 0
-        with parser:
-            metadata = extractMetadata(parser)
-        if metadata and metadata.has("duration"):
-            return int(metadata.get("duration").total_seconds())
+        return int(float(out.decode().strip() or 0))
     except Exception:
         return 0
-    return 0
+
+def make_thumbnail_image(path: Path):
+    """Shrinks a photo in place to a 320px JPEG thumbnail. Blocking; run it in a thread."""
+    with Image.open(path) as img:
+        img.draft("RGB", (640, 640)) # Let libjpeg downscale while decoding
+        img.thumbnail((320, 320))
+        thumb = img.convert("RGB")
+    # 4:2:0 at q80 stays well under Telegram's 200 KiB thumbnail limit and encodes faster than the defaults
+    thumb.save(path, "JPEG", quality=80, optimize=True, progressive=False, subsampling=2)
+
+def make_post_image(path: Path):
+    """Shrinks a post photo in place to fit 1080px. Blocking; run it in a thread."""
+    with Image.open(path) as img:
+        img.draft("RGB", (2160, 2160)) # Let libjpeg downscale while decoding large photos
+        img.thumbnail((1080, 1080)) # Resize for reasonable Telegram limit
+        post_img = img.convert("RGB")
+    post_img.save(path, "JPEG")
 
 def parse_time(time_str: str) -> int:
     """Parses a time string like '5s', '1m', '1h 30s' into seconds."""
@@ -135,9 +227,40 @@ def parse_time(time_str: str) -> int:
             total_seconds += int(part[:-1]) * 3600
     return total_seconds
 
+TMP_SEQ = itertools.count(1)
+
+def tmp_id() -> str:
+    """Unique tag for temp file names; two jobs started in the same second no longer share a path."""
+    return f"{time.monotonic_ns()}_{next(TMP_SEQ)}"
+
+def retry_delay(attempt: int) -> float:
+    """Exponential backoff with jitter for transient errors, capped at 60 seconds."""
+    return min(60, 2 ** attempt + random.random())
+
+async def wait_send_slot():
+    """Reserve the next free send slot and sleep until it arrives."""
+    global TG_NEXT_SEND_AT
+    now = time.monotonic()
+    slot = max(now, TG_NEXT_SEND_AT)
+    TG_NEXT_SEND_AT = slot + 1 / TG_SEND_RATE
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+async def delete_messages_chunked(c: Client, chat_id: int, message_ids: list):
+    """Delete messages in batches of 100, the most Telegram accepts per call. Errors are logged, not raised."""
+    for i in range(0, len(message_ids), 100):
+        try:
+            await c.delete_messages(chat_id=chat_id, message_ids=message_ids[i:i + 100])
+        except Exception as e:
+            logger.warning("Failed to delete messages in %s: %s", chat_id, e)
+
 def progress_keyboard():
     return InlineKeyboardMarkup([[InlineKeyboardButton("Cancel ❌", callback_data="cancel_task")]])
 
+def broadcast_keyboard():
+    # Separate from progress_keyboard: cancel_task stops uploads and conversions, not broadcasts
+    return InlineKeyboardMarkup([[InlineKeyboardButton("Cancel ❌", callback_data="cancel_broadcast")]])
+
 def delete_caption_keyboard():
     return InlineKeyboardMarkup([[InlineKeyboardButton("Delete Caption 🗑️", callback_data="delete_caption")]])
 
@@ -199,7 +322,7 @@ def generate_post_caption(data: dict) -> str:
     season_entries = []
     
     # Clean up the input string and split by comma or space
-    parts = re.split(r'[,\s]+', season_list_raw.strip())
+    parts = SEASON_LIST_SPLIT_RE.split(season_list_raw.strip())
     parts = [p.strip() for p in parts if p.strip()]
 
     for part in parts:
@@ -278,26 +401,75 @@ def pyrogram_progress_wrapper(current, total, message_obj, start_time_obj, task_
 
 # ---- robust download stream with retries ----
 async def download_stream(resp, out_path: Path, message: Message = None, cancel_event: asyncio.Event = None):
-    total = 0
     try:
         size = int(resp.headers.get("Content-Length", 0))
-    except:
+    except ValueError:
         size = 0
-    chunk_size = 1024 * 1024
-    try:
-        with out_path.open("wb") as f:
+    # Reject oversized files up front instead of downloading up to the limit first
+    if size > MAX_SIZE:
+        return False, "ফাইলের সাইজ 4GB এর বেশি হতে পারে না।"
+    chunk_size = 4 * 1024 * 1024
+    # The reader fills a small queue while the writer drains it, so network and disk I/O overlap
+    queue = asyncio.Queue(maxsize=4)
+
+    async def read_chunks():
+        total = 0
+        try:
             async for chunk in resp.content.iter_chunked(chunk_size):
                 if cancel_event and cancel_event.is_set():
                     return False, "অপারেশন ব্যবহারকারী দ্বারা বাতিল করা হয়েছে।"
                 if not chunk:
                     break
+                # Content-Length doesn't bound the body: aiohttp transparently decompresses gzip/deflate responses
+                total += len(chunk)
                 if total > MAX_SIZE:
                     return False, "ফাইলের সাইজ 4GB এর বেশি হতে পারে না।"
-                total += len(chunk)
-                f.write(chunk)
-    except Exception as e:
-        return False, str(e)
-    return True, None
+                await queue.put(chunk)
+        finally:
+            await queue.put(None)
+        return True, None
+
+    async def write_chunks():
+        # Keep draining after a write error so the reader never blocks on a full queue
+        f = None
+        error = None
+        preallocated = False
+        try:
+            f = await aiofiles.open(out_path, "wb")
+            if size and hasattr(os, "posix_fallocate"):
+                # Reserve the whole file up front: one extent allocation instead of one per write
+                try:
+                    await asyncio.to_thread(os.posix_fallocate, f.fileno(), 0, size)
+                    preallocated = True
+                except OSError:
+                    pass
+        except Exception as e:
+            error = e
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            if error is None:
+                try:
+                    await f.write(chunk)
+                except Exception as e:
+                    error = e
+        if f is not None:
+            if preallocated and error is None:
+                # Drop any reserved tail the body never filled (e.g. a short or re-encoded response)
+                try:
+                    await f.truncate()
+                except Exception as e:
+                    error = e
+            await f.close()
+        if error is not None:
+            raise error
+
+    results = await asyncio.gather(read_chunks(), write_chunks(), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            return False, str(result)
+    return results[0]
 
 async def fetch_with_retries(session, url, method="GET", max_tries=3, **kwargs):
     backoff = 1
@@ -312,51 +484,159 @@ async def fetch_with_retries(session, url, method="GET", max_tries=3, **kwargs):
             backoff *= 2
     raise RuntimeError("unreachable")
 
-async def download_url_generic(url: str, out_path: Path, message: Message = None, cancel_event: asyncio.Event = None):
-    timeout = aiohttp.ClientTimeout(total=7200)
-    headers = {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64)"}
-    connector = aiohttp.TCPConnector(limit=0, force_close=True)
-    async with aiohttp.ClientSession(timeout=timeout, headers=headers, connector=connector) as sess:
+# Shared HTTP session: keeps connections alive across downloads and Drive redirects
+HTTP_SESSION = None
+
+async def get_http_session() -> aiohttp.ClientSession:
+    global HTTP_SESSION
+    if HTTP_SESSION is None or HTTP_SESSION.closed:
+        timeout = aiohttp.ClientTimeout(total=7200)
+        headers = {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64)"}
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=8, ttl_dns_cache=300, keepalive_timeout=75)
+        # Match the read buffer to download_stream's 4 MiB chunks so the socket isn't paused at the 64 KiB default
+        HTTP_SESSION = aiohttp.ClientSession(timeout=timeout, headers=headers, connector=connector, read_bufsize=4 * 1024 * 1024)
+    return HTTP_SESSION
+
+def ranged_download_size(resp: aiohttp.ClientResponse):
+    """Returns the size to fetch in parallel byte ranges, or None if this response should just be streamed."""
+    # Read from the response already in hand, so small files and servers without Range support cost no extra request
+    if resp.headers.get("Accept-Ranges", "").lower() != "bytes":
+        return None
+    if resp.headers.get("Content-Encoding", "identity").lower() != "identity":
+        return None
+    size = resp.content_length
+    if not size or size < RANGE_DOWNLOAD_MIN_SIZE or size > MAX_SIZE:
+        return None
+    return size
+
+def pwrite_all(fd: int, data: bytes, offset: int):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+async def download_byte_ranges(sess: aiohttp.ClientSession, url: str, size: int, out_path: Path, cancel_event: asyncio.Event = None):
+    """Fetches url as RANGE_DOWNLOAD_PARTS parallel Range requests, each written at its own offset."""
+    part_size = -(-size // RANGE_DOWNLOAD_PARTS)
+    ranges = [(lo, min(lo + part_size, size) - 1) for lo in range(0, size, part_size)]
+    loop = asyncio.get_running_loop()
+    writes = set()
+    fd = os.open(out_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if hasattr(os, "posix_fallocate"):
+            await asyncio.to_thread(os.posix_fallocate, fd, 0, size)
+        else:
+            await asyncio.to_thread(os.ftruncate, fd, size)
+
+        async def fetch_range(lo, hi):
+            async with sess.get(url, headers={"Range": f"bytes={lo}-{hi}"}) as resp:
+                if resp.status != 206:
+                    raise Exception(f"HTTP {resp.status} for bytes {lo}-{hi}")
+                offset = lo
+                async for chunk in resp.content.iter_chunked(4 * 1024 * 1024):
+                    if cancel_event and cancel_event.is_set():
+                        return
+                    write = loop.run_in_executor(None, pwrite_all, fd, chunk, offset)
+                    writes.add(write)
+                    write.add_done_callback(writes.discard)
+                    await asyncio.shield(write)
+                    offset += len(chunk)
+                if offset != hi + 1:
+                    raise Exception(f"bytes {lo}-{hi} ended at {offset}")
+
+        tasks = [asyncio.ensure_future(fetch_range(lo, hi)) for lo, hi in ranges]
         try:
-            async with sess.get(url, allow_redirects=True) as resp:
-                if resp.status != 200:
-                    return False, f"HTTP {resp.status}"
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+    finally:
+        # A cancelled part can still have a pwrite running in the executor; it must finish before the fd is closed
+        if writes:
+            await asyncio.gather(*writes, return_exceptions=True)
+        os.close(fd)
+
+async def download_url_ranged(sess: aiohttp.ClientSession, url: str, size: int, out_path: Path, cancel_event: asyncio.Event = None):
+    """Parallel download for large files. Returns None when the ranges fail, so the caller streams instead."""
+    try:
+        await download_byte_ranges(sess, url, size, out_path, cancel_event)
+    except Exception as e:
+        logger.warning("Ranged download failed, falling back to a single stream: %s", e)
+        return None
+    if cancel_event and cancel_event.is_set():
+        return False, "অপারেশন ব্যবহারকারী দ্বারা বাতিল করা হয়েছে।"
+    return True, None
+
+async def download_url_generic(url: str, out_path: Path, message: Message = None, cancel_event: asyncio.Event = None):
+    sess = await get_http_session()
+    try:
+        async with sess.get(url, allow_redirects=True) as resp:
+            if resp.status != 200:
+                return False, f"HTTP {resp.status}"
+            size = ranged_download_size(resp)
+            if size is None:
                 return await download_stream(resp, out_path, message, cancel_event=cancel_event)
-        except Exception as e:
-            return False, str(e)
+            # Large file on a server that accepts ranges: drop this body unread and fetch it in parallel parts
+            url = str(resp.url)
+            resp.close()
+        ranged = await download_url_ranged(sess, url, size, out_path, cancel_event)
+        if ranged is not None:
+            return ranged
+        async with sess.get(url) as resp:
+            if resp.status != 200:
+                return False, f"HTTP {resp.status}"
+            return await download_stream(resp, out_path, message, cancel_event=cancel_event)
+    except Exception as e:
+        return False, str(e)
 
 async def download_drive_file(file_id: str, out_path: Path, message: Message = None, cancel_event: asyncio.Event = None):
     base = f"https://drive.google.com/uc?export=download&id={file_id}"
-    timeout = aiohttp.ClientTimeout(total=7200)
-    headers = {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64)"}
-    connector = aiohttp.TCPConnector(limit=0, force_close=True)
-    async with aiohttp.ClientSession(timeout=timeout, headers=headers, connector=connector) as sess:
-        try:
-            async with sess.get(base, allow_redirects=True) as resp:
-                if resp.status == 200 and "content-disposition" in (k.lower() for k in resp.headers.keys()):
-                    return await download_stream(resp, out_path, message, cancel_event=cancel_event)
-                text = await resp.text(errors="ignore")
-                m = re.search(r"confirm=([0-9A-Za-z-_]+)", text)
-                if m:
-                    token = m.group(1)
-                    download_url = f"https://drive.google.com/uc?export=download&confirm={token}&id={file_id}"
-                    async with sess.get(download_url, allow_redirects=True) as resp2:
-                        if resp2.status != 200:
-                            return False, f"HTTP {resp2.status}"
-                        return await download_stream(resp2, out_path, message, cancel_event=cancel_event)
-                for k, v in resp.cookies.items():
-                    if k.startswith("download_warning"):
-                        token = v.value
-                        download_url = f"https://drive.google.com/uc?export=download&confirm={token}&id={file_id}"
-                        async with sess.get(download_url, allow_redirects=True) as resp2:
-                            if resp2.status != 200:
-                                return False, f"HTTP {resp2.status}"
-                            return await download_stream(resp2, out_path, message, cancel_event=cancel_event)
-                return False, "ডাউনলোডের জন্য Google Drive থেকে অনুমতি প্রয়োজন বা লিংক পাবলিক নয়।"
-        except Exception as e:
-            return False, str(e)
+    sess = await get_http_session()
+    try:
+        async with sess.get(base, allow_redirects=True) as resp:
+            if resp.status == 200 and "content-disposition" in (k.lower() for k in resp.headers.keys()):
+                return await download_stream(resp, out_path, message, cancel_event=cancel_event)
+            # The warning cookie carries the token without reading the page at all
+            token = next((v.value for k, v in resp.cookies.items() if k.startswith("download_warning")), None)
+            if token is None:
+                # Otherwise scan the HTML as it arrives and stop at the first confirm= token (or after 256 KiB)
+                text = ""
+                read = 0
+                async for chunk in resp.content.iter_chunked(16384):
+                    text += chunk.decode("utf-8", errors="ignore")
+                    read += len(chunk)
+                    m = DRIVE_CONFIRM_RE.search(text)
+                    # A match running to the end of the buffer may be a token cut off mid-chunk
+                    if m and m.end() < len(text):
+                        token = m.group(1)
+                        break
+                    if read > 256 * 1024:
+                        break
+                    # Only the tail can still hold the start of a token
+                    text = text[m.start():] if m else text[-64:]
+                else:
+                    m = DRIVE_CONFIRM_RE.search(text)
+                    if m:
+                        token = m.group(1)
+        # The HTML response is released on leaving the block, before the real download starts,
+        # so it doesn't hold a pooled connection that the ranged download could use
+        if not token:
+            return False, "ডাউনলোডের জন্য Google Drive থেকে অনুমতি প্রয়োজন বা লিংক পাবলিক নয়।"
+        download_url = f"https://drive.google.com/uc?export=download&confirm={token}&id={file_id}"
+        return await download_url_generic(download_url, out_path, message, cancel_event)
+    except Exception as e:
+        return False, str(e)
+
+# Commands are static, so they only need to be registered once per process
+BOT_COMMANDS_SET = False
 
 async def set_bot_commands():
+    global BOT_COMMANDS_SET
+    if BOT_COMMANDS_SET:
+        return
     cmds = [
         BotCommand("start", "বট চালু/হেল্প"),
         BotCommand("upload_url", "URL থেকে ফাইল ডাউনলোড ও আপলোড (admin only)"),
@@ -371,10 +651,12 @@ async def set_bot_commands():
         BotCommand("create_post", "নতুন পোস্ট তৈরি করুন (admin only)"), # NEW COMMAND
         BotCommand("mode_check", "বর্তমান মোড স্ট্যাটাস চেক করুন (admin only)"), 
         BotCommand("broadcast", "ব্রডকাস্ট (কেবল অ্যাডমিন)"),
+        BotCommand("cancel_broadcast", "চলমান ব্রডকাস্ট বাতিল করুন (কেবল অ্যাডমিন)"),
         BotCommand("help", "সহায়িকা")
     ]
     try:
         await app.set_bot_commands(cmds)
+        BOT_COMMANDS_SET = True
     except Exception as e:
         logger.warning("Set commands error: %s", e)
 
@@ -399,6 +681,7 @@ async def start_handler(c, m: Message):
         "/create_post - নতুন পোস্ট তৈরি করুন (admin only)\n" # NEW COMMAND in help
         "/mode_check - বর্তমান মোড স্ট্যাটাস চেক করুন এবং পরিবর্তন করুন (admin only)\n" 
         "/broadcast <text> - ব্রডকাস্ট (শুধুমাত্র অ্যাডমিন)\n"
+        "/cancel_broadcast - চলমান ব্রডকাস্ট বাতিল করুন (শুধুমাত্র অ্যাডমিন)\n"
         "/help - সাহায্য"
     )
     await m.reply_text(text)
@@ -408,11 +691,8 @@ async def help_handler(c, m):
     await start_handler(c, m)
 
 @app.on_message(filters.command("setthumb") & filters.private)
+@admin_only
 async def setthumb_prompt(c, m):
-    if not is_admin(m.from_user.id):
-        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
-        return
-    
     uid = m.from_user.id
     if len(m.command) > 1:
         time_str = " ".join(m.command[1:])
@@ -428,15 +708,13 @@ async def setthumb_prompt(c, m):
 
 
 @app.on_message(filters.command("view_thumb") & filters.private)
+@admin_only
 async def view_thumb_cmd(c, m: Message):
-    if not is_admin(m.from_user.id):
-        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
-        return
     uid = m.from_user.id
     thumb_path = USER_THUMBS.get(uid)
     thumb_time = USER_THUMB_TIME.get(uid)
     
-    if thumb_path and Path(thumb_path).exists():
+    if thumb_path and await asyncio.to_thread(os.path.exists, thumb_path):
         await c.send_photo(chat_id=m.chat.id, photo=thumb_path, caption="এটা আপনার সেভ করা থাম্বনেইল।")
     elif thumb_time:
         await m.reply_text(f"আপনার থাম্বনেইল তৈরির সময় সেট করা আছে: {thumb_time} সেকেন্ড।")
@@ -444,16 +722,14 @@ async def view_thumb_cmd(c, m: Message):
         await m.reply_text("আপনার কোনো থাম্বনেইল বা থাম্বনেইল তৈরির সময় সেভ করা নেই। /setthumb দিয়ে সেট করুন।")
 
 @app.on_message(filters.command("del_thumb") & filters.private)
+@admin_only
 async def del_thumb_cmd(c, m: Message):
-    if not is_admin(m.from_user.id):
-        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
-        return
     uid = m.from_user.id
     thumb_path = USER_THUMBS.get(uid)
-    if thumb_path and Path(thumb_path).exists():
+    if thumb_path:
         try:
-            Path(thumb_path).unlink()
-        except Exception:
+            await asyncio.to_thread(Path(thumb_path).unlink, missing_ok=True)
+        except OSError:
             pass
         USER_THUMBS.pop(uid, None)
     
@@ -466,10 +742,8 @@ async def del_thumb_cmd(c, m: Message):
         await m.reply_text("আপনার থাম্বনেইল/থাম্বনেইল তৈরির সময় মুছে ফেলা হয়েছে।")
 
 
-@app.on_message(filters.photo & filters.private)
+@app.on_message(filters.photo & filters.private & admin_filter)
 async def photo_handler(c, m: Message):
-    if not is_admin(m.from_user.id):
-        return
     uid = m.from_user.id
     
     # --- NEW: Handle Create Post Mode ---
@@ -484,10 +758,7 @@ async def photo_handler(c, m: Message):
             state_data['message_ids'].append(download_msg.id)
             
             await m.download(file_name=str(out))
-            img = Image.open(out)
-            img.thumbnail((1080, 1080)) # Resize for reasonable Telegram limit
-            img = img.convert("RGB")
-            img.save(out, "JPEG")
+            await asyncio.to_thread(make_post_image, out)
             
             state_data['image_path'] = str(out)
             state_data['state'] = 'awaiting_name_change'
@@ -517,7 +788,7 @@ async def photo_handler(c, m: Message):
             await m.reply_text(f"ছবি সেভ করতে সমস্যা: {e}")
             CREATE_POST_MODE.discard(uid)
             POST_CREATION_STATE.pop(uid, None)
-            if out.exists(): out.unlink(missing_ok=True)
+            out.unlink(missing_ok=True)
         return
     # --- END NEW: Handle Create Post Mode ---
     
@@ -526,10 +797,7 @@ async def photo_handler(c, m: Message):
         out = TMP / f"thumb_{uid}.jpg"
         try:
             await m.download(file_name=str(out))
-            img = Image.open(out)
-            img.thumbnail((320, 320))
-            img = img.convert("RGB")
-            img.save(out, "JPEG")
+            await asyncio.to_thread(make_thumbnail_image, out)
             USER_THUMBS[uid] = str(out)
             # Make sure to clear the time setting if a photo is set
             USER_THUMB_TIME.pop(uid, None)
@@ -541,10 +809,8 @@ async def photo_handler(c, m: Message):
 
 # Handlers for caption
 @app.on_message(filters.command("set_caption") & filters.private)
+@admin_only
 async def set_caption_prompt(c, m: Message):
-    if not is_admin(m.from_user.id):
-        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
-        return
     SET_CAPTION_REQUEST.add(m.from_user.id)
     # Reset counter data when a new caption is about to be set
     USER_COUNTERS.pop(m.from_user.id, None)
@@ -557,10 +823,8 @@ async def set_caption_prompt(c, m: Message):
     )
 
 @app.on_message(filters.command("view_caption") & filters.private)
+@admin_only
 async def view_caption_cmd(c, m: Message):
-    if not is_admin(m.from_user.id):
-        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
-        return
     uid = m.from_user.id
     caption = USER_CAPTIONS.get(uid)
     if caption:
@@ -583,11 +847,9 @@ async def delete_caption_cb(c, cb):
 
 # Handler to toggle edit caption mode
 @app.on_message(filters.command("edit_caption_mode") & filters.private)
+@admin_only
 async def toggle_edit_caption_mode(c, m: Message):
     uid = m.from_user.id
-    if not is_admin(uid):
-        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
-        return
 
     if uid in EDIT_CAPTION_MODE:
         EDIT_CAPTION_MODE.discard(uid)
@@ -598,11 +860,9 @@ async def toggle_edit_caption_mode(c, m: Message):
 
 # --- HANDLER: /mkv_video_audio_change ---
 @app.on_message(filters.command("mkv_video_audio_change") & filters.private)
+@admin_only
 async def toggle_audio_change_mode(c, m: Message):
     uid = m.from_user.id
-    if not is_admin(uid):
-        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
-        return
 
     if uid in MKV_AUDIO_CHANGE_MODE:
         MKV_AUDIO_CHANGE_MODE.discard(uid)
@@ -622,11 +882,9 @@ async def toggle_audio_change_mode(c, m: Message):
 
 # --- NEW HANDLER: /create_post ---
 @app.on_message(filters.command("create_post") & filters.private)
+@admin_only
 async def toggle_create_post_mode(c, m: Message):
     uid = m.from_user.id
-    if not is_admin(uid):
-        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
-        return
 
     if uid in CREATE_POST_MODE:
         CREATE_POST_MODE.discard(uid)
@@ -644,7 +902,7 @@ async def toggle_create_post_mode(c, m: Message):
                 if post_id and post_id in messages_to_delete:
                     messages_to_delete.remove(post_id) 
                 if messages_to_delete:
-                    await c.delete_messages(m.chat.id, messages_to_delete)
+                    await delete_messages_chunked(c, m.chat.id, messages_to_delete)
             except Exception as e:
                 logger.warning(f"Post mode OFF cleanup error: {e}")
                 
@@ -665,11 +923,9 @@ async def toggle_create_post_mode(c, m: Message):
 
 # --- NEW HANDLER: /mode_check ---
 @app.on_message(filters.command("mode_check") & filters.private)
+@admin_only
 async def mode_check_cmd(c, m: Message):
     uid = m.from_user.id
-    if not is_admin(uid):
-        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
-        return
     
     audio_status = "✅ ON" if uid in MKV_AUDIO_CHANGE_MODE else "❌ OFF"
     caption_status = "✅ ON" if uid in EDIT_CAPTION_MODE else "❌ OFF"
@@ -748,11 +1004,10 @@ async def mode_toggle_callback(c: Client, cb: CallbackQuery):
         await cb.answer(message, show_alert=True)
 
 
-@app.on_message(filters.text & filters.private)
+# Commands are excluded so they reach their own handlers instead of this catch-all
+@app.on_message(filters.text & filters.private & ~filters.regex(r"^/") & admin_filter)
 async def text_handler(c, m: Message):
     uid = m.from_user.id
-    if not is_admin(uid):
-        return
     text = m.text.strip()
     
     # Handle set caption request
@@ -919,14 +1174,11 @@ async def text_handler(c, m: Message):
                 all_messages.remove(post_id) 
             # Delete all conversation messages
             if all_messages:
-                try:
-                    await c.delete_messages(m.chat.id, all_messages)
-                except Exception as e:
-                    logger.warning(f"Error deleting post creation messages: {e}")
+                await delete_messages_chunked(c, m.chat.id, all_messages)
             
             # Cleanup state image_path = state_data['image_path']
             image_path = state_data['image_path']
-            if image_path and Path(image_path).exists():
+            if image_path:
                 Path(image_path).unlink(missing_ok=True)
             
             CREATE_POST_MODE.discard(uid)
@@ -938,14 +1190,12 @@ async def text_handler(c, m: Message):
 
 
     # Handle auto URL upload
-    if text.startswith("http://") or text.startswith("https://"):
+    if text.startswith(("http://", "https://")):
         asyncio.create_task(handle_url_download_and_upload(c, m, text))
     
 @app.on_message(filters.command("upload_url") & filters.private)
+@admin_only
 async def upload_url_cmd(c, m: Message):
-    if not is_admin(m.from_user.id):
-        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
-        return
     if not m.command or len(m.command) < 2:
         await m.reply_text("ব্যবহার: /upload_url <url>\nউদাহরণ: /upload_url https://example.com/file.mp4")
         return
@@ -953,30 +1203,26 @@ async def upload_url_cmd(c, m: Message):
     asyncio.create_task(handle_url_download_and_upload(c, m, url))
 
 async def handle_url_download_and_upload(c: Client, m: Message, url: str):
+    global DOWNLOADS_WAITING
     uid = m.from_user.id
     cancel_event = asyncio.Event()
-    TASKS.setdefault(uid, []).append(cancel_event)
+    TASKS.setdefault(uid, set()).add(cancel_event)
 
     try:
         status_msg = await m.reply_text("ডাউনলোড শুরু হচ্ছে...", reply_markup=progress_keyboard())
     except Exception:
         status_msg = await m.reply_text("ডাউনলোড শুরু হচ্ছে...", reply_markup=progress_keyboard())
     try:
-        fname = url.split("/")[-1].split("?")[0] or f"download_{int(datetime.now().timestamp())}"
-        safe_name = re.sub(r"[\\/*?\"<>|:]", "_", fname)
+        fname = url.split("/")[-1].split("?")[0] or f"download_{int(time.time())}"
+        safe_name = fname.translate(UNSAFE_FILENAME_TABLE)
 
-        video_exts = {".mp4", ".mkv", ".avi", ".mov", ".flv", ".wmv", ".webm"}
-        if not any(safe_name.lower().endswith(ext) for ext in video_exts):
+        if Path(safe_name).suffix.lower() not in VIDEO_EXTS:
             safe_name += ".mp4"
 
-        tmp_in = TMP / f"dl_{uid}_{int(datetime.now().timestamp())}_{safe_name}"
+        tmp_in = TMP / f"dl_{uid}_{tmp_id()}_{safe_name}"
         ok, err = False, None
-        
-        try:
-            await status_msg.edit("ডাউনলোড হচ্ছে...", reply_markup=progress_keyboard())
-        except Exception:
-            status_msg = await m.reply_text("ডাউনলোড হচ্ছে...", reply_markup=progress_keyboard())
 
+        fid = None
         if is_drive_url(url):
             fid = extract_drive_id(url)
             if not fid:
@@ -984,11 +1230,36 @@ async def handle_url_download_and_upload(c: Client, m: Message, url: str):
                     await status_msg.edit("Google Drive লিঙ্ক থেকে file id পাওয়া যায়নি। সঠিক লিংক দিন।", reply_markup=None)
                 except Exception:
                     await m.reply_text("Google Drive লিঙ্ক থেকে file id পাওয়া যায়নি। সঠিক লিংক দিন।", reply_markup=None)
-                TASKS[uid].remove(cancel_event)
+                TASKS[uid].discard(cancel_event)
                 return
-            ok, err = await download_drive_file(fid, tmp_in, status_msg, cancel_event=cancel_event)
-        else:
-            ok, err = await download_url_generic(url, tmp_in, status_msg, cancel_event=cancel_event)
+
+        queued = DOWNLOAD_SEM.locked()
+        if queued:
+            DOWNLOADS_WAITING += 1
+            try:
+                await status_msg.edit(f"ডাউনলোড কিউতে আছে (অবস্থান {DOWNLOADS_WAITING})...", reply_markup=progress_keyboard())
+            except Exception:
+                pass
+        try:
+            await DOWNLOAD_SEM.acquire()
+        finally:
+            if queued:
+                DOWNLOADS_WAITING -= 1
+        try:
+            if cancel_event.is_set():
+                ok, err = False, "অপারেশন ব্যবহারকারী দ্বারা বাতিল করা হয়েছে।"
+            else:
+                try:
+                    await status_msg.edit("ডাউনলোড হচ্ছে...", reply_markup=progress_keyboard())
+                except Exception:
+                    status_msg = await m.reply_text("ডাউনলোড হচ্ছে...", reply_markup=progress_keyboard())
+
+                if fid:
+                    ok, err = await download_drive_file(fid, tmp_in, status_msg, cancel_event=cancel_event)
+                else:
+                    ok, err = await download_url_generic(url, tmp_in, status_msg, cancel_event=cancel_event)
+        finally:
+            DOWNLOAD_SEM.release()
 
         if not ok:
             try:
@@ -996,11 +1267,10 @@ async def handle_url_download_and_upload(c: Client, m: Message, url: str):
             except Exception:
                 await m.reply_text(f"ডাউনলোড ব্যর্থ: {err}", reply_markup=None)
             try:
-                if tmp_in.exists():
-                    tmp_in.unlink()
-            except:
+                tmp_in.unlink(missing_ok=True)
+            except OSError:
                 pass
-            TASKS[uid].remove(cancel_event)
+            TASKS[uid].discard(cancel_event)
             return
 
         try:
@@ -1020,10 +1290,7 @@ async def handle_url_download_and_upload(c: Client, m: Message, url: str):
         except Exception:
             await m.reply_text(f"অপস! কিছু ভুল হয়েছে: {e}", reply_markup=None)
     finally:
-        try:
-            TASKS[uid].remove(cancel_event)
-        except Exception:
-            pass
+        TASKS[uid].discard(cancel_event)
 
 async def handle_caption_only_upload(c: Client, m: Message):
     uid = m.from_user.id
@@ -1033,7 +1300,7 @@ async def handle_caption_only_upload(c: Client, m: Message):
         return
 
     cancel_event = asyncio.Event()
-    TASKS.setdefault(uid, []).append(cancel_event)
+    TASKS.setdefault(uid, set()).add(cancel_event)
     
     try:
         status_msg = await m.reply_text("ক্যাপশন এডিট করা হচ্ছে...", reply_markup=progress_keyboard())
@@ -1109,16 +1376,11 @@ async def handle_caption_only_upload(c: Client, m: Message):
         except Exception:
             await m.reply_text(f"ক্যাপশন এডিটে ত্রুটি: {e}", reply_markup=None)
     finally:
-        try:
-            TASKS[uid].remove(cancel_event)
-        except Exception:
-            pass
+        TASKS[uid].discard(cancel_event)
 
-@app.on_message(filters.private & (filters.video | filters.document))
+@app.on_message(filters.private & (filters.video | filters.document) & admin_filter)
 async def forwarded_file_or_direct_file(c: Client, m: Message):
     uid = m.from_user.id
-    if not is_admin(uid):
-        return
 
     # --- Check for MKV Audio Change Mode first ---
     if uid in MKV_AUDIO_CHANGE_MODE:
@@ -1137,7 +1399,7 @@ async def forwarded_file_or_direct_file(c: Client, m: Message):
     if m.forward_date:
         # Original logic for forwarded file handling
         cancel_event = asyncio.Event()
-        TASKS.setdefault(uid, []).append(cancel_event)
+        TASKS.setdefault(uid, set()).add(cancel_event)
         
         file_info = m.video or m.document
         
@@ -1152,7 +1414,7 @@ async def forwarded_file_or_direct_file(c: Client, m: Message):
             status_msg = await m.reply_text("ফরওয়ার্ড করা ফাইল ডাউনলোড শুরু হচ্ছে...", reply_markup=progress_keyboard())
         except Exception:
             status_msg = await m.reply_text("ফরওয়ার্ড করা ফাইল ডাউনলোড শুরু হচ্ছে...", reply_markup=progress_keyboard())
-        tmp_path = TMP / f"forwarded_{uid}_{int(datetime.now().timestamp())}_{original_name}"
+        tmp_path = TMP / f"forwarded_{uid}_{tmp_id()}_{original_name}"
         try:
             await m.download(file_name=str(tmp_path))
             try:
@@ -1168,10 +1430,7 @@ async def forwarded_file_or_direct_file(c: Client, m: Message):
         except Exception as e:
             await m.reply_text(f"ফাইল প্রসেসিংয়ে সমস্যা: {e}")
         finally:
-            try:
-                TASKS[uid].remove(cancel_event)
-            except Exception:
-                pass
+            TASKS[uid].discard(cancel_event)
     else:
         # A direct video/document which isn't handled by another mode. Pass.
         pass
@@ -1197,7 +1456,7 @@ async def handle_audio_change_file(c: Client, m: Message):
     
     # Download the file
     cancel_event = asyncio.Event()
-    TASKS.setdefault(uid, []).append(cancel_event)
+    TASKS.setdefault(uid, set()).add(cancel_event)
     
     tmp_path = None
     status_msg = None
@@ -1207,7 +1466,7 @@ async def handle_audio_change_file(c: Client, m: Message):
         if not '.' in original_name:
             original_name += '.mkv'
             
-        tmp_path = TMP / f"audio_change_{uid}_{int(datetime.now().timestamp())}_{original_name}"
+        tmp_path = TMP / f"audio_change_{uid}_{tmp_id()}_{original_name}"
         
         status_msg = await m.reply_text("অডিও ট্র্যাক বিশ্লেষণের জন্য ফাইল ডাউনলোড করা হচ্ছে...", reply_markup=progress_keyboard())
         await m.download(file_name=str(tmp_path))
@@ -1284,20 +1543,17 @@ async def handle_audio_change_file(c: Client, m: Message):
             await status_msg.edit(f"অডিও ট্র্যাক বিশ্লেষণে সমস্যা: {e}")
         else:
             await m.reply_text(f"অডিও ট্র্যাক বিশ্লেষণে সমস্যা: {e}")
-        if tmp_path and tmp_path.exists():
+        if tmp_path:
             tmp_path.unlink(missing_ok=True)
     finally:
-        try:
-            TASKS[uid].remove(cancel_event)
-        except Exception:
-            pass
+        TASKS[uid].discard(cancel_event)
 # -----------------------------------------------------
 
 # --- HANDLER FUNCTION: Handle audio remux ---
 async def handle_audio_remux(c: Client, m: Message, in_path: Path, original_name: str, new_stream_map: list, messages_to_delete: list = None):
     uid = m.from_user.id
     cancel_event = asyncio.Event()
-    TASKS.setdefault(uid, []).append(cancel_event)
+    TASKS.setdefault(uid, set()).add(cancel_event)
     
     # NEW RENAME FEATURE: অডিও পরিবর্তন করার পর নতুন নাম সেট করা
     out_name = generate_new_filename(original_name)
@@ -1305,7 +1561,7 @@ async def handle_audio_remux(c: Client, m: Message, in_path: Path, original_name
     if not out_name.lower().endswith(".mkv"):
         out_name = out_name.split(".")[0] + ".mkv"
     # ------------------------------------------------------------------
-    out_path = TMP / f"remux_{uid}_{int(datetime.now().timestamp())}_{out_name}"
+    out_path = TMP / f"remux_{uid}_{tmp_id()}_{out_name}"
     
     map_args = ["-map", "0:v", "-map", "0:s?", "-map", "0:d?"] # 0:s? and 0:d? maps them if they exist
     # Add the user-specified audio maps
@@ -1327,20 +1583,13 @@ async def handle_audio_remux(c: Client, m: Message, in_path: Path, original_name
     try:
         status_msg = await m.reply_text("অডিও ট্র্যাক অর্ডার পরিবর্তন করা হচ্ছে (Remuxing)...", reply_markup=progress_keyboard())
         
-        # Run the FFmpeg command
-        result = await asyncio.to_thread(
-            subprocess.run,
-            cmd,
-            capture_output=True,
-            text=True,
-            check=False,
-            timeout=3600
-        )
+        # Run the FFmpeg command; the Cancel button kills it mid-remux
+        returncode, stderr = await run_ffmpeg(cmd, timeout=3600, cancel_event=cancel_event)
         
-        if result.returncode != 0:
-            logger.error(f"FFmpeg Remux failed: {result.stderr}")
+        if returncode != 0:
+            logger.error(f"FFmpeg Remux failed: {stderr}")
             out_path.unlink(missing_ok=True)
-            raise Exception(f"FFmpeg Remux ব্যর্থ হয়েছে। ত্রুটি: {result.stderr[:500]}...")
+            raise Exception(f"FFmpeg Remux ব্যর্থ হয়েছে। ত্রুটি: ...{stderr[-500:]}")
 
         if not out_path.exists() or out_path.stat().st_size == 0:
             raise Exception("পরিবর্তিত ফাইলটি পাওয়া যায়নি বা শূন্য আকারের।")
@@ -1366,18 +1615,16 @@ async def handle_audio_remux(c: Client, m: Message, in_path: Path, original_name
         try:
             in_path.unlink(missing_ok=True)
             out_path.unlink(missing_ok=True)
-            TASKS[uid].remove(cancel_event)
-        except Exception:
-            pass
+        except OSError as e:
+            logger.warning("Temp file cleanup failed: %s", e)
+        TASKS[uid].discard(cancel_event)
 # ---------------------------------------------------
 
 
 @app.on_message(filters.command("rename") & filters.private)
+@admin_only
 async def rename_cmd(c, m: Message):
     uid = m.from_user.id
-    if not is_admin(uid):
-        await m.reply_text("আপনার অনুমতি নেই।")
-        return
     if not m.reply_to_message or not (m.reply_to_message.video or m.reply_to_message.document):
         await m.reply_text("ভিডিও/ডকুমেন্ট ফাইলের reply দিয়ে এই কমান্ড দিন।\nUsage: /rename new_name.mp4")
         return
@@ -1385,19 +1632,19 @@ async def rename_cmd(c, m: Message):
         await m.reply_text("নতুন ফাইল নাম দিন। উদাহরণ: /rename new_video.mp4")
         return
     new_name = m.text.split(None, 1)[1].strip()
-    new_name = re.sub(r"[\\/*?\"<>|:]", "_", new_name)
+    new_name = new_name.translate(UNSAFE_FILENAME_TABLE)
     
     # NOTE: /rename is an explicit user command to set a custom name, so we don't apply the auto-rename here.
     
     await m.reply_text(f"ভিডিও রিনেম করা হবে: {new_name}\n(রিনেম করতে reply করা ফাইলটি পুনরায় ডাউনলোড করে আপলোড করা হবে)")
 
     cancel_event = asyncio.Event()
-    TASKS.setdefault(uid, []).append(cancel_event)
+    TASKS.setdefault(uid, set()).add(cancel_event)
     try:
         status_msg = await m.reply_text("রিনেমের জন্য ফাইল ডাউনলোড করা হচ্ছে...", reply_markup=progress_keyboard())
     except Exception:
         status_msg = await m.reply_text("রিনেমের জন্য ফাইল ডাউনলোড করা হচ্ছে...", reply_markup=progress_keyboard())
-    tmp_out = TMP / f"rename_{uid}_{int(datetime.now().timestamp())}_{new_name}"
+    tmp_out = TMP / f"rename_{uid}_{tmp_id()}_{new_name}"
     try:
         await m.reply_to_message.download(file_name=str(tmp_out))
         try:
@@ -1408,20 +1655,16 @@ async def rename_cmd(c, m: Message):
     except Exception as e:
         await m.reply_text(f"রিনেম ত্রুটি: {e}")
     finally:
-        try:
-            TASKS[uid].remove(cancel_event)
-        except Exception:
-            pass
+        TASKS[uid].discard(cancel_event)
 
 @app.on_callback_query(filters.regex("cancel_task"))
 async def cancel_task_cb(c, cb):
     uid = cb.from_user.id
-    if uid in TASKS and TASKS[uid]:
-        for ev in list(TASKS[uid]):
-            try:
-                ev.set()
-            except:
-                pass
+    if TASKS.get(uid):
+        # Each handler discards its own event when it unwinds; clearing here just stops a second press re-cancelling
+        for ev in TASKS[uid]:
+            ev.set()
+        TASKS[uid].clear()
         
         # New: Clean up audio change state if in progress
         if uid in MKV_AUDIO_CHANGE_MODE:
@@ -1447,8 +1690,81 @@ async def cancel_task_cb(c, cb):
         await cb.answer("কোনো অপারেশন চলছে না।", show_alert=True)
 
 # ---- main processing and upload (functions simplified for brevity, assuming they work) ----
-async def generate_video_thumbnail(video_path: Path, thumb_path: Path, timestamp_sec: int = 1):
+async def run_ffmpeg(cmd: list, timeout: int, cancel_event: asyncio.Event = None):
+    """Runs an ffmpeg command as an async subprocess so the event loop keeps running. Returns (returncode, stderr).
+
+    Only the last FFMPEG_STDERR_TAIL lines of stderr are kept, so a long encode doesn't buffer its whole log.
+    The process is stopped if it outlives timeout or if cancel_event is set while it runs.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stderr_tail = deque(maxlen=FFMPEG_STDERR_TAIL)
+
+    async def collect():
+        # Progress updates end in \r rather than \n, so split on both and read in chunks instead of readline()
+        pending = b""
+        while chunk := await proc.stderr.read(64 * 1024):
+            lines = (pending + chunk).replace(b"\r", b"\n").split(b"\n")
+            pending = lines.pop()[-4096:]
+            stderr_tail.extend(line for line in lines if line.strip())
+        if pending.strip():
+            stderr_tail.append(pending)
+        return await proc.wait()
+
+    communicate = asyncio.ensure_future(collect())
+    cancel_wait = asyncio.ensure_future(cancel_event.wait()) if cancel_event else None
+    try:
+        waiters = {communicate, cancel_wait} if cancel_wait else {communicate}
+        await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if communicate.done():
+            return communicate.result(), b"\n".join(stderr_tail).decode(errors="replace")
+        if cancel_event and cancel_event.is_set():
+            raise Exception("ffmpeg cancelled")
+        raise Exception(f"ffmpeg timed out after {timeout}s")
+    finally:
+        if cancel_wait:
+            cancel_wait.cancel()
+        if not communicate.done():
+            # SIGINT lets ffmpeg close its output cleanly; kill it if it hasn't exited within a few seconds
+            try:
+                proc.send_signal(signal.SIGINT)
+                await asyncio.wait_for(asyncio.shield(communicate), timeout=3)
+            except ProcessLookupError:
+                pass
+            except asyncio.TimeoutError:
+                proc.kill()
+            await communicate
+
+def thumb_cache_key(video_path: Path, timestamp_sec: int) -> str:
+    """Identifies a video by the SHA-1 of its first 4 MiB plus its size, so re-uploads of the same file hit the cache."""
+    with video_path.open("rb") as f:
+        head = f.read(4 * 1024 * 1024)
+    return f"{hashlib.sha1(head).hexdigest()}_{video_path.stat().st_size}_{timestamp_sec}"
+
+def remember_thumb(key: str, thumb_path: Path):
+    # Cache files live directly in TMP so periodic_cleanup also ages out entries orphaned by a restart
+    cached = TMP / f"thumbcache_{key}.jpg"
+    shutil.copyfile(thumb_path, cached)
+    THUMB_CACHE[key] = cached
+    while len(THUMB_CACHE) > THUMB_CACHE_MAX_ENTRIES:
+        _, old = THUMB_CACHE.popitem(last=False)
+        old.unlink(missing_ok=True)
+
+async def generate_video_thumbnail(video_path: Path, thumb_path: Path, timestamp_sec: int = 1, cancel_event: asyncio.Event = None):
     try:
+        key = await asyncio.to_thread(thumb_cache_key, video_path, timestamp_sec)
+        cached = THUMB_CACHE.get(key)
+        if cached:
+            try:
+                await asyncio.to_thread(shutil.copyfile, cached, thumb_path)
+                THUMB_CACHE.move_to_end(key)
+                return True
+            except OSError:
+                THUMB_CACHE.pop(key, None)
+
         cmd = [
             "ffmpeg",
             "-y",
@@ -1458,29 +1774,41 @@ async def generate_video_thumbnail(video_path: Path, thumb_path: Path, timestamp
             "-vf", "scale=320:-1",
             str(thumb_path)
         ]
-        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
-        return thumb_path.exists() and thumb_path.stat().st_size > 0
+        await run_ffmpeg(cmd, timeout=300, cancel_event=cancel_event)
+        if not (thumb_path.exists() and thumb_path.stat().st_size > 0):
+            return False
+        try:
+            await asyncio.to_thread(remember_thumb, key, thumb_path)
+        except OSError as e:
+            logger.warning("Thumbnail cache write error: %s", e)
+        return True
     except Exception as e:
         logger.warning("Thumbnail generate error: %s", e)
         return False
 
-async def convert_to_mkv(in_path: Path, out_path: Path, status_msg: Message):
+async def convert_to_mkv(in_path: Path, out_path: Path, status_msg: Message, cancel_event: asyncio.Event = None):
     try:
         try:
             await status_msg.edit("ভিডিওটি MKV ফরম্যাটে কনভার্ট করা হচ্ছে...", reply_markup=progress_keyboard())
         except Exception:
             await status_msg.edit("ভিডিওটি MKV ফরম্যাটে কনভার্ট করা হচ্ছে...", reply_markup=progress_keyboard())
-        # Use simple stream copy first
+        # Use stream copy first; Matroska can carry almost any audio/video/subtitle codec,
+        # and regenerated timestamps let AVI/FLV sources copy instead of re-encoding.
+        # Data streams (e.g. QuickTime timecode) are left out because the Matroska muxer rejects them.
         cmd = [
             "ffmpeg",
+            "-y",
+            "-fflags", "+genpts",
             "-i", str(in_path),
-            "-codec", "copy",
+            *MKV_STREAM_MAP,
+            "-c", "copy",
+            "-f", "matroska",
             str(out_path)
         ]
         
-        result = subprocess.run(cmd, capture_output=True, text=True, check=False, timeout=1200)
+        returncode, _ = await run_ffmpeg(cmd, timeout=1200, cancel_event=cancel_event)
         
-        if result.returncode != 0 or not out_path.exists() or out_path.stat().st_size == 0:
+        if returncode != 0 or not out_path.exists() or out_path.stat().st_size == 0:
             # Fallback to full re-encoding if stream copy fails
             logger.warning("Container conversion failed or output is empty, attempting full re-encoding.")
             try:
@@ -1493,18 +1821,21 @@ async def convert_to_mkv(in_path: Path, out_path: Path, status_msg: Message):
 
             cmd_full = [
                 "ffmpeg",
+                "-y",
                 "-i", str(in_path),
+                *MKV_STREAM_MAP,
                 "-c:v", "libx264",
-                "-preset", "fast",
+                "-preset", "veryfast",
                 "-crf", "23",
                 "-c:a", "copy",
+                # Subtitles use the muxer's default encoder, so text tracks like mov_text become ASS
                 "-map_metadata", "0", # Keep metadata from input
-                "-movflags", "+faststart", # For MP4
+                "-f", "matroska",
                 str(out_path)
             ]
-            result_full = subprocess.run(cmd_full, capture_output=True, text=True, check=False, timeout=3600)
-            if result_full.returncode != 0:
-                raise Exception(f"Full re-encoding failed: {result_full.stderr}")
+            returncode_full, stderr_full = await run_ffmpeg(cmd_full, timeout=3600, cancel_event=cancel_event)
+            if returncode_full != 0:
+                raise Exception(f"Full re-encoding failed: {stderr_full}")
 
         if not out_path.exists() or out_path.stat().st_size == 0:
             raise Exception("Converted file not found or is empty.")
@@ -1519,106 +1850,99 @@ def process_dynamic_caption(uid, caption_template):
     # Initialize user state if it doesn't exist
     if uid not in USER_COUNTERS:
         USER_COUNTERS[uid] = {'uploads': 0, 'episode_numbers': {}, 'dynamic_counters': {}, 're_options_count': 0}
+    state = USER_COUNTERS[uid]
+    counters = state['dynamic_counters']
 
     # Increment upload counter for the current user
-    USER_COUNTERS[uid]['uploads'] += 1
+    state['uploads'] += 1
+    uploads = state['uploads']
+
+    # Every placeholder starts with '[', so plain captions skip all regex work
+    has_placeholders = "[" in caption_template
 
     # --- 1. Quality Cycle Logic (e.g., [re (480p, 720p, 1080p)]) ---
-    quality_match = re.search(r"\[re\s*\((.*?)\)\]", caption_template)
+    quality_match = CAPTION_QUALITY_RE.search(caption_template) if has_placeholders else None
+    current_quality = None
+    # Counters advance by one on every upload after the first...
+    advance = uploads > 1
     if quality_match:
         options_str = quality_match.group(1)
         options = [opt.strip() for opt in options_str.split(',')]
         
         # Store the number of options if not already stored
-        if not USER_COUNTERS[uid]['re_options_count']:
-            USER_COUNTERS[uid]['re_options_count'] = len(options)
+        if not state['re_options_count']:
+            state['re_options_count'] = len(options)
         
         # Calculate the current index in the cycle
-        current_index = (USER_COUNTERS[uid]['uploads'] - 1) % len(options)
-        current_quality = options[current_index]
-        
-        # Replace the placeholder with the current quality
-        caption_template = caption_template.replace(quality_match.group(0), current_quality)
+        current_quality = options[(uploads - 1) % len(options)]
 
-        # Check if a full cycle has completed and increment counters
-        # Increment happens when we are about to start a new cycle (i.e., when (uploads - 1) % len == 0, but for uploads > 1)
-        if (USER_COUNTERS[uid]['uploads'] - 1) % USER_COUNTERS[uid]['re_options_count'] == 0 and USER_COUNTERS[uid]['uploads'] > 1:
-            # Increment all dynamic counters
-            for key in USER_COUNTERS[uid]['dynamic_counters']:
-                USER_COUNTERS[uid]['dynamic_counters'][key]['value'] += 1
-    elif USER_COUNTERS[uid]['uploads'] > 1: # Increment all counters if no quality cycle is used
-        for key in USER_COUNTERS[uid].get('dynamic_counters', {}):
-             USER_COUNTERS[uid]['dynamic_counters'][key]['value'] += 1
+        # ...or, with a quality cycle, only when a new cycle starts
+        advance = advance and (uploads - 1) % state['re_options_count'] == 0
 
 
     # --- 2. Main counter logic (e.g., [12], [(21)]) ---
-    # Find all number-based placeholders
-    counter_matches = re.findall(r"\[\s*(\(?\d+\)?)\s*\]", caption_template)
-    
     # Initialize counters on the first upload
-    if USER_COUNTERS[uid]['uploads'] == 1:
-        for match in counter_matches:
+    if uploads == 1 and has_placeholders:
+        for match in CAPTION_COUNTER_RE.findall(caption_template):
             # Check if the number has parentheses
             has_paren = match.startswith('(') and match.endswith(')')
             # Clean the number to use as a key
-            clean_match = re.sub(r'[()]', '', match)
-            # Store the original format and the starting value
-            USER_COUNTERS[uid]['dynamic_counters'][match] = {'value': int(clean_match), 'has_paren': has_paren}
-    
-    # If not first upload but no quality cycle, the counter has already been incremented above. 
-    # If the quality cycle is used, the increment happens inside the quality cycle logic.
+            clean_match = match.translate(STRIP_PARENS_TABLE)
+            # Store the starting value, the original format and the zero-padded width (e.g., '[01]' is 2 digits)
+            counters[match] = {'value': int(clean_match), 'has_paren': has_paren, 'width': len(clean_match)}
+        if counters:
+            # All counters advance together, so the smallest one can be kept up to date instead of searched for
+            state['min_value'] = min(data['value'] for data in counters.values())
+
+    # Advance each counter and render its placeholder in the same pass, e.g. '[01]' -> '02', '[(21)]' -> '(22)'
+    if advance and counters:
+        state['min_value'] += 1
+    rendered_counters = {}
+    for match, data in counters.items():
+        if advance:
+            data['value'] += 1
+        formatted_value = f"{data['value']:0{data['width']}d}"
+        # Add parentheses back if they existed
+        rendered_counters[f"[{match}]"] = f"({formatted_value})" if data['has_paren'] else formatted_value
 
-    # Replace placeholders with their current values
-    for match, data in USER_COUNTERS[uid]['dynamic_counters'].items():
-        value = data['value']
-        has_paren = data['has_paren']
-        
-        # Format the number with leading zeros if necessary (02, 03, etc.)
-        # Use the length of the original match to determine padding (e.g., '[01]' should be 2 digits)
-        original_num_len = len(re.sub(r'[()]', '', match))
-        formatted_value = f"{value:0{original_num_len}d}"
+    def substitute_placeholder(mo):
+        placeholder = mo.group(0)
+        if mo.group(1) is not None:
+            # Only the first quality placeholder found above is cycled
+            return current_quality if placeholder == quality_match.group(0) else placeholder
+        return rendered_counters.get(placeholder, placeholder)
 
-        # Add parentheses back if they existed
-        final_value = f"({formatted_value})" if has_paren else formatted_value
-        
-        # This regex will replace all occurrences of the specific placeholder, e.g., '[12]' or '[(21)]'
-        caption_template = re.sub(re.escape(f"[{match}]"), final_value, caption_template)
+    # Quality and counter placeholders are replaced in a single scan of the caption
+    if has_placeholders:
+        caption_template = CAPTION_PLACEHOLDER_RE.sub(substitute_placeholder, caption_template)
 
 
     # --- 3. New Conditional Text Logic (e.g., [End (02)], [hi (05)]) ---
     
-    # Find the current episode number. We assume the smallest starting number counter 
-    # (e.g. from [01]) represents the episode number.
-    current_episode_num = 0
-    # Find the smallest starting value among dynamic counters to represent the "episode number"
-    if USER_COUNTERS[uid].get('dynamic_counters'):
-        current_episode_num = min(data['value'] for data in USER_COUNTERS[uid]['dynamic_counters'].values())
-
-    # New regex to find [TEXT (XX)] format. 
-    # Group 1: TEXT (e.g., End, hi)
-    # Group 2: XX (e.g., 02, 05)
-    conditional_matches = re.findall(r"\[([a-zA-Z0-9\s]+)\s*\((.*?)\)\]", caption_template)
+    # The smallest counter (e.g. from [01]) represents the episode number
+    current_episode_num = state['min_value'] if counters else 0
+
+    # [TEXT (XX)] placeholders: group 1 is TEXT (e.g., End, hi), group 2 is XX (e.g., 02, 05).
+    # Each one is resolved with a plain str.replace of its canonical "[TEXT (XX)]" spelling;
+    # replacements are letters/digits only, so this matches what an escaped re.sub would do
+    # without compiling a new pattern per placeholder.
+    conditional_matches = CAPTION_CONDITIONAL_RE.findall(caption_template) if has_placeholders else []
 
     for match in conditional_matches:
         text_to_add = match[0].strip() # e.g., "End", "hi"
-        target_num_str = re.sub(r'[^0-9]', '', match[1]).strip() # e.g., "02", "05"
+        target_num_str = NON_DIGIT_RE.sub('', match[1]).strip() # e.g., "02", "05"
+
+        placeholder = f"[{text_to_add} ({match[1].strip()})]"
 
-        placeholder = re.escape(f"[{match[0].strip()} ({match[1].strip()})]")
-        
         try:
             target_num = int(target_num_str)
         except ValueError:
-            # Invalid number, skip or replace with empty string
-            caption_template = re.sub(placeholder, "", caption_template)
+            # Invalid number, replace with empty string
+            caption_template = caption_template.replace(placeholder, "")
             continue
-        
-        # FIX: New logic - show TEXT only if current_episode_num IS EQUAL TO target_num
-        if current_episode_num == target_num:
-            # Replace placeholder with the actual TEXT
-            caption_template = re.sub(placeholder, text_to_add, caption_template)
-        else:
-            # Replace placeholder with an empty string
-            caption_template = re.sub(placeholder, "", caption_template)
+
+        # Show TEXT only if current_episode_num IS EQUAL TO target_num, otherwise drop the placeholder
+        caption_template = caption_template.replace(placeholder, text_to_add if current_episode_num == target_num else "")
 
     # Final formatting
     return "**" + "\n".join(caption_template.splitlines()) + "**"
@@ -1627,25 +1951,34 @@ def process_dynamic_caption(uid, caption_template):
 async def process_file_and_upload(c: Client, m: Message, in_path: Path, original_name: str = None, messages_to_delete: list = None):
     uid = m.from_user.id
     cancel_event = asyncio.Event()
-    TASKS.setdefault(uid, []).append(cancel_event)
+    TASKS.setdefault(uid, set()).add(cancel_event)
     
     upload_path = in_path
-    temp_thumb_path = None
     final_caption_template = USER_CAPTIONS.get(uid)
     status_msg = None # Initialize status_msg
+    # Every temp file is registered here as soon as its path exists, so the finally block removes all of them
+    cleanup = contextlib.ExitStack()
+    cleanup.callback(in_path.unlink, missing_ok=True)
 
+    slot_acquired = False
     try:
+        # Waiting for a slot happens inside the try so a cancelled wait still cleans up in_path and TASKS
+        if UPLOAD_SEM.locked():
+            logger.info("All upload slots busy; upload for %s is queued", uid)
+        await UPLOAD_SEM.acquire()
+        slot_acquired = True
         # NOTE: original_name is already the desired final name due to changes in calling functions
         final_name = original_name or in_path.name
         
         # সংশোধিত লাইন: Pyrogram-এর ডিটেকশন ব্যর্থ হলেও ফাইলের এক্সটেনশন দেখে ভিডিও হিসেবে চিহ্নিত করবে।
-        video_exts = {".mp4", ".mkv", ".avi", ".mov", ".flv", ".wmv", ".webm"}
-        is_video = bool(m.video) or any(in_path.suffix.lower() == ext for ext in video_exts)
+        suffix = in_path.suffix.lower()
+        is_video = bool(m.video) or suffix in VIDEO_EXTS
         
         if is_video:
             # Only convert if it's NOT .mp4 OR .mkv, as mkv is the preferred format for video/document
-            if in_path.suffix.lower() not in {".mp4", ".mkv"}:
+            if suffix not in NO_CONVERT_EXTS:
                 mkv_path = TMP / f"{in_path.stem}.mkv"
+                cleanup.callback(mkv_path.unlink, missing_ok=True)
                 try:
                     status_msg = await m.reply_text(f"ভিডিওটি {in_path.suffix} ফরম্যাটে আছে। MKV এ কনভার্ট করা হচ্ছে...", reply_markup=progress_keyboard())
                 except Exception:
@@ -1655,7 +1988,7 @@ async def process_file_and_upload(c: Client, m: Message, in_path: Path, original
                 else:
                     messages_to_delete = [status_msg.id]
                     
-                ok, err = await convert_to_mkv(in_path, mkv_path, status_msg)
+                ok, err = await convert_to_mkv(in_path, mkv_path, status_msg, cancel_event)
                 if not ok:
                     try:
                         await status_msg.edit(f"কনভার্সন ব্যর্থ: {err}\nমূল ফাইলটি আপলোড করা হচ্ছে...", reply_markup=None)
@@ -1669,9 +2002,10 @@ async def process_file_and_upload(c: Client, m: Message, in_path: Path, original
         thumb_path = USER_THUMBS.get(uid)
         
         if is_video and not thumb_path:
-            temp_thumb_path = TMP / f"thumb_{uid}_{int(datetime.now().timestamp())}.jpg"
+            temp_thumb_path = TMP / f"thumb_{uid}_{tmp_id()}.jpg"
+            cleanup.callback(temp_thumb_path.unlink, missing_ok=True)
             thumb_time_sec = USER_THUMB_TIME.get(uid, 1) # Default to 1 second
-            ok = await generate_video_thumbnail(upload_path, temp_thumb_path, timestamp_sec=thumb_time_sec)
+            ok = await generate_video_thumbnail(upload_path, temp_thumb_path, timestamp_sec=thumb_time_sec, cancel_event=cancel_event)
             if ok:
                 thumb_path = str(temp_thumb_path)
 
@@ -1693,18 +2027,16 @@ async def process_file_and_upload(c: Client, m: Message, in_path: Path, original
 
         if cancel_event.is_set():
             if messages_to_delete:
-                try:
-                    await c.delete_messages(chat_id=m.chat.id, message_ids=messages_to_delete)
-                except Exception:
-                    pass
+                await delete_messages_chunked(c, m.chat.id, messages_to_delete)
             try:
                 await status_msg.edit("অপারেশন বাতিল করা হয়েছে, আপলোড শুরু করা হয়নি।", reply_markup=None)
             except Exception:
                 await m.reply_text("অপারেশন বাতিল করা হয়েছে, আপলোড শুরু করা হয়নি।", reply_markup=None)
-            TASKS[uid].remove(cancel_event)
+            TASKS[uid].discard(cancel_event)
             return
         
-        duration_sec = get_video_duration(upload_path) if upload_path.exists() else 0
+        # ffprobe already yields 0 for a missing file, so there is no separate exists() check on the loop
+        duration_sec = await get_video_duration(upload_path)
         
         caption_to_use = final_name
         if final_caption_template:
@@ -1714,6 +2046,7 @@ async def process_file_and_upload(c: Client, m: Message, in_path: Path, original
         last_exc = None
         for attempt in range(1, upload_attempts + 1):
             try:
+                await wait_send_slot()
                 if is_video:
                     await c.send_video(
                         chat_id=m.chat.id,
@@ -1735,25 +2068,23 @@ async def process_file_and_upload(c: Client, m: Message, in_path: Path, original
                     )
                 
                 if messages_to_delete:
-                    try:
-                        # Delete all tracked messages on SUCCESS
-                        await c.delete_messages(chat_id=m.chat.id, message_ids=messages_to_delete)
-                    except Exception:
-                        pass
+                    await delete_messages_chunked(c, m.chat.id, messages_to_delete)
                 
                 last_exc = None
                 break
+            except FloodWait as e:
+                # Telegram says exactly how long to wait; retrying sooner only extends the flood ban
+                last_exc = e
+                logger.warning("Upload attempt %s hit FloodWait, waiting %ss", attempt, e.value)
+                await asyncio.sleep(e.value + 1)
             except Exception as e:
                 last_exc = e
                 logger.warning("Upload attempt %s failed: %s", attempt, e)
-                await asyncio.sleep(2 * attempt)
-                if cancel_event.is_set():
-                    if messages_to_delete:
-                        try:
-                            await c.delete_messages(chat_id=m.chat.id, message_ids=messages_to_delete)
-                        except Exception:
-                            pass
-                    break
+                await asyncio.sleep(retry_delay(attempt))
+            if cancel_event.is_set():
+                if messages_to_delete:
+                    await delete_messages_chunked(c, m.chat.id, messages_to_delete)
+                break
 
         if last_exc:
             if status_msg:
@@ -1767,98 +2098,174 @@ async def process_file_and_upload(c: Client, m: Message, in_path: Path, original
             await m.reply_text(f"আপলোডে ত্রুটি: {e}")
     finally:
         try:
-            # Clean up files
-            if upload_path != in_path and upload_path.exists():
-                upload_path.unlink()
-            if in_path.exists():
-                in_path.unlink()
-            if temp_thumb_path and Path(temp_thumb_path).exists():
-                Path(temp_thumb_path).unlink()
-            TASKS[uid].remove(cancel_event)
-        except Exception:
-            pass
+            # ExitStack runs every callback even if an earlier unlink fails
+            cleanup.close()
+        except OSError as e:
+            logger.warning("Temp file cleanup failed: %s", e)
+        TASKS[uid].discard(cancel_event)
+        if slot_acquired:
+            UPLOAD_SEM.release()
 
 # *** সংশোধিত: ব্রডকাস্ট কমান্ড ***
 @app.on_message(filters.command("broadcast") & filters.private)
-async def broadcast_cmd_no_reply(c, m: Message):
+@admin_only
+async def broadcast_cmd(c, m: Message):
     uid = m.from_user.id
-    if not is_admin(uid):
-        await m.reply_text("আপনার অনুমতি নেই।")
-        return
-    if not m.reply_to_message:
+
+    source_message = m.reply_to_message
+    if not source_message:
         await m.reply_text("ব্রডকাস্ট করতে যেকোনো মেসেজে (ছবি, ভিডিও বা টেক্সট) **রিপ্লাই করে** এই কমান্ড দিন।")
         return
 
-@app.on_message(filters.command("broadcast") & filters.private & filters.reply)
-async def broadcast_cmd_reply(c, m: Message):
+    # Immutable snapshot: /start may add subscribers and the summary may prune them while this runs.
+    # The set difference also drops the admin's own chat.
+    targets = tuple(SUBSCRIBERS - {m.chat.id})
+    # Set only by the broadcast's own Cancel button or /cancel_broadcast, never by cancel_task
+    cancel_event = asyncio.Event()
+    BROADCAST_TASKS.setdefault(uid, set()).add(cancel_event)
+    try:
+        await run_broadcast(c, m, source_message, targets, cancel_event)
+    finally:
+        BROADCAST_TASKS[uid].discard(cancel_event)
+
+async def run_broadcast(c: Client, m: Message, source_message: Message, targets: tuple, cancel_event: asyncio.Event):
+    total = len(targets)
+    status_msg = await m.reply_text(f"ব্রডকাস্ট শুরু হচ্ছে {total} সাবস্ক্রাইবারে...", quote=True, reply_markup=broadcast_keyboard())
+    # Copy concurrently, but keep only a bounded number of requests in flight.
+    # Each chat gets a single message, so there is no per-chat ordering to preserve.
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    # copy_message re-fetches the source message for every chat; media is re-sent straight from its file_id and text from its entities
+    media = getattr(source_message, source_message.media.value, None) if source_message.media else None
+    file_id = getattr(media, "file_id", None)
+
+    async def send_one(chat_id):
+        await wait_send_slot()
+        if file_id:
+            await c.send_cached_media(
+                chat_id=chat_id,
+                file_id=file_id,
+                caption=source_message.caption or "",
+                caption_entities=source_message.caption_entities,
+                reply_markup=source_message.reply_markup,
+                disable_notification=True
+            )
+        elif source_message.text:
+            # Plain text is rebuilt locally from the text and its entities, with no server-side copy
+            await c.send_message(
+                chat_id=chat_id,
+                text=source_message.text,
+                entities=source_message.entities,
+                reply_markup=source_message.reply_markup,
+                disable_web_page_preview=not source_message.web_page,
+                disable_notification=True
+            )
+        else:
+            await c.copy_message(chat_id=chat_id, from_chat_id=source_message.chat.id, message_id=source_message.id, disable_notification=True)
+
+    async def broadcast_one(chat_id, max_tries=3):
+        """Returns True once sent, False if the broadcast was cancelled before this chat got it."""
+        async with sem:
+            for attempt in range(1, max_tries + 1):
+                if cancel_event.is_set():
+                    return False
+                try:
+                    await send_one(chat_id)
+                    return True
+                except FloodWait as e:
+                    if attempt == max_tries:
+                        raise
+                    await asyncio.sleep(e.value)
+                except (InternalServerError, OSError, asyncio.TimeoutError):
+                    # Transient server/network trouble; 4xx errors (blocked, invalid peer) are final and not retried
+                    if attempt == max_tries:
+                        raise
+                    await asyncio.sleep(retry_delay(attempt))
+
+    done = 0
+    last_edit = time.monotonic()
+
+    async def tracked(chat_id):
+        # Count every finished chat, but edit the status message at most once per interval
+        nonlocal done, last_edit
+        try:
+            return await broadcast_one(chat_id)
+        finally:
+            done += 1
+            now = time.monotonic()
+            if now - last_edit >= BROADCAST_PROGRESS_INTERVAL and done < total:
+                last_edit = now
+                try:
+                    await status_msg.edit(f"ব্রডকাস্ট চলছে... {done}/{total}", reply_markup=broadcast_keyboard())
+                except Exception:
+                    pass
+
+    results = await asyncio.gather(*(tracked(chat_id) for chat_id in targets), return_exceptions=True)
+    # One summary line per broadcast; per-chat details only at DEBUG
+    fail_kinds = Counter()
+    for chat_id, result in zip(targets, results):
+        if isinstance(result, Exception):
+            fail_kinds[type(result).__name__] += 1
+            if isinstance(result, (UserIsBlocked, PeerIdInvalid, InputUserDeactivated, UserDeactivated, ChatWriteForbidden)):
+                # Blocked, deleted or unwritable chat; drop it until it sends /start again
+                SUBSCRIBERS.discard(chat_id)
+            logger.debug("Broadcast to %s failed: %s", chat_id, result)
+    failed = sum(fail_kinds.values())
+    sent = sum(1 for result in results if result is True)
+    if fail_kinds:
+        logger.warning("Broadcast failures: %s", dict(fail_kinds))
+
+    summary = f"ব্রডকাস্ট শেষ। পাঠানো: {sent}, ব্যর্থ: {failed}"
+    if cancel_event.is_set():
+        summary = f"ব্রডকাস্ট বাতিল করা হয়েছে। পাঠানো: {sent}, ব্যর্থ: {failed}, বাকি: {total - sent - failed}"
+    try:
+        await status_msg.edit(summary, reply_markup=None)
+    except Exception:
+        await m.reply_text(summary)
+
+@app.on_message(filters.command("cancel_broadcast") & filters.private)
+@admin_only
+async def cancel_broadcast_cmd(c, m: Message):
     uid = m.from_user.id
+    events = BROADCAST_TASKS.get(uid)
+    if not events:
+        await m.reply_text("কোনো ব্রডকাস্ট চলছে না।")
+        return
+    for ev in list(events):
+        ev.set()
+    await m.reply_text("ব্রডকাস্ট বাতিল করা হচ্ছে...")
+
+@app.on_callback_query(filters.regex("^cancel_broadcast$"))
+async def cancel_broadcast_cb(c, cb):
+    uid = cb.from_user.id
     if not is_admin(uid):
-        await m.reply_text("আপনার অনুমতি নেই।")
+        await cb.answer("আপনার অনুমতি নেই।", show_alert=True)
         return
-    
-    source_message = m.reply_to_message
-    if not source_message:
-        await m.reply_text("ব্রডকাস্ট করার জন্য একটি মেসেজে রিপ্লাই করে এই কমান্ড দিন।")
+    events = BROADCAST_TASKS.get(uid)
+    if not events:
+        await cb.answer("কোনো ব্রডকাস্ট চলছে না।", show_alert=True)
         return
-
-    await m.reply_text(f"ব্রডকাস্ট শুরু হচ্ছে {len(SUBSCRIBERS)} সাবস্ক্রাইবারে...", quote=True)
-    failed = 0
-    sent = 0
-    for chat_id in list(SUBSCRIBERS):
-        if chat_id == m.chat.id:
-            continue
-        try:
-            await c.forward_messages(chat_id=chat_id, from_chat_id=source_message.chat.id, message_ids=source_message.id)
-            sent += 1
-            await asyncio.sleep(0.08)
-        except Exception as e:
-            failed += 1
-            logger.warning("Broadcast to %s failed: %s", chat_id, e)
-
-    await m.reply_text(f"ব্রডকাস্ট শেষ। পাঠানো: {sent}, ব্যর্থ: {failed}")
-
-# --- Flask Web Server ---
-@flask_app.route('/')
-def home():
-    html_content = """
-    <!DOCTYPE-html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Bot Status</title>
-        <style>
-            body {
-                font-family: Arial, sans-serif;
-                background-color: #f0f2f5;
-                color: #333;
-                text-align: center;
-                padding-top: 50px;
-            }
-            .container {
-                background-color: #fff;
-                padding: 30px;
-                border-radius: 10px;
-                box-shadow: 0 4px 8px rgba(0,0,0,0.1);
-                display: inline-block;
-            }
-            h1 {
-                color: #28a745;
-            }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>TA File Share Bot is running! ✅</h1>
-            <p>This page confirms that the bot's web server is active.</p>
-        </div>
-    </body>
-    </html>
-    """
-    return render_template_string(html_content)
+    # The status message stays; run_broadcast edits it into the summary once in-flight sends finish
+    for ev in list(events):
+        ev.set()
+    await cb.answer("ব্রডকাস্ট বাতিল করা হচ্ছে...")
+
+# --- Web Server (keeps the Render port bound; runs on the bot's event loop) ---
+STATUS_TEXT = "TA File Share Bot is running! ✅"
+
+async def home(request):
+    # Only Render's health check and the keep-alive ping hit this; a short plain-text body is enough
+    return web.Response(text=STATUS_TEXT)
+
+async def start_web_server():
+    web_app = web.Application()
+    web_app.router.add_get("/", home)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", PORT).start()
+    return runner
 
 # Ping service to keep the bot alive
-def ping_service():
+async def ping_service():
     if not RENDER_EXTERNAL_HOSTNAME:
         print("Render URL is not set. Ping service is disabled.")
         return
@@ -1866,41 +2273,50 @@ def ping_service():
     url = f"http://{RENDER_EXTERNAL_HOSTNAME}"
     while True:
         try:
-            response = requests.get(url, timeout=10)
-            print(f"Pinged {url} | Status Code: {response.status_code}")
-        except requests.exceptions.RequestException as e:
+            sess = await get_http_session()
+            async with sess.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                print(f"Pinged {url} | Status Code: {response.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             print(f"Error pinging {url}: {e}")
-        time.sleep(600)
-
-def run_flask_and_ping():
-    flask_thread = threading.Thread(target=lambda: flask_app.run(host="0.0.0.0", port=PORT, use_reloader=False))
-    flask_thread.start()
-    ping_thread = threading.Thread(target=ping_service)
-    ping_thread.start()
-    print("Flask and Ping services started.")
+        await asyncio.sleep(600)
+
+def cleanup_tmp_dir(max_age=3 * 86400):
+    """Delete files in TMP older than max_age seconds. Blocking; run in a thread."""
+    # DirEntry caches the type bits from readdir, so only files need an extra stat
+    cutoff = time.time() - max_age
+    with os.scandir(TMP) as it:
+        for entry in it:
+            try:
+                if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+            except OSError:
+                pass
 
 async def periodic_cleanup():
     while True:
         try:
-            now = datetime.now()
-            for p in TMP.iterdir():
-                try:
-                    if p.is_file():
-                        if now - datetime.fromtimestamp(p.stat().st_mtime) > timedelta(days=3):
-                            p.unlink()
-                except Exception:
-                    pass
+            await asyncio.to_thread(cleanup_tmp_dir)
         except Exception:
             pass
         await asyncio.sleep(3600)
 
-if __name__ == "__main__":
-    print("Bot চালু হচ্ছে... Flask and Ping threads start করা হচ্ছে, তারপর Pyrogram চালু হবে।")
-    t = threading.Thread(target=run_flask_and_ping, daemon=True)
-    t.start()
+async def main():
+    web_runner = await start_web_server()
+    print("Web server started.")
+    await app.start()
+    cleanup_task = asyncio.create_task(periodic_cleanup())
+    ping_task = asyncio.create_task(ping_service())
     try:
-        loop = asyncio.get_event_loop()
-        loop.create_task(periodic_cleanup())
-    except RuntimeError:
-        pass
-    app.run()
+        await idle()
+    finally:
+        cleanup_task.cancel()
+        ping_task.cancel()
+        await app.stop()
+        await web_runner.cleanup()
+        if HTTP_SESSION is not None:
+            await HTTP_SESSION.close()
+
+if __name__ == "__main__":
+    print("Bot চালু হচ্ছে... Web server, Pyrogram এবং Ping service চালু করা হচ্ছে।")
+    # app.run() drives the loop the Client was created on; asyncio.run() would start a second one
+    app.run(main())